@@ -7,7 +7,7 @@
 import numpy as np
 import torch
 import torch.nn as nn
-from scipy.stats import combine_pvalues
+from scipy.stats import chi2
 from scipy.special import betainc
 import time
 import os
@@ -20,6 +20,17 @@ import logging
 from logger import setup_logger
 logger = logging.getLogger(__name__)
 
+# Feature extraction runs under autocast in this dtype on GPUs that support it natively
+AUTOCAST_DTYPE = torch.bfloat16
+
+def use_autocast(device):
+    """
+    Only autocast to bfloat16 on GPUs with native support (Ampere and newer), on older
+    ones it's emulated and slower than the float32 it replaces
+    """
+    return (torch.device(device).type == "cuda" and 
+            torch.cuda.is_bf16_supported(including_emulation=False))
+
 def cosine_pvalue(c, d):
     """
     Given a dimension d, returns the probability that the dot product between
@@ -35,43 +46,89 @@ def cosine_pvalue(c, d):
     else:
         return 1 - cosine_pvalue(-c, d=d)
 
+def cosine_pvalue_vec(c, d):
+    """
+    Vectorized version of cosine_pvalue, c is an array of dot products and
+    a single betainc call is made over all of them. Computed in float64, in float32
+    the p-values of strongly marked classes underflow to 0.
+    """
+    c = np.asarray(c, dtype=np.float64)
+    a = (d - 1) / 2.
+    b = 1 / 2.
+
+    tail = 0.5 * betainc(a, b, 1 - c**2)
+    return np.where(c >= 0, tail, 1 - tail)
+
+def fisher_combine_pvalues(p_vals):
+    """
+    Fisher's method, same result as scipy.stats.combine_pvalues(p_vals)
+    but always computed in float64
+    """
+    p_vals = np.asarray(p_vals, dtype=np.float64)
+    statistic = -2 * np.sum(np.log(p_vals))
+
+    return statistic, chi2.sf(statistic, 2 * p_vals.size)
+
+def allocate_features(n, d, device, keep_on_device):
+    """
+    Allocates the (n, d) float32 buffer extracted features are copied into. Every row
+    gets written so it's left uninitialized.
+    """
+    if keep_on_device:
+        return torch.empty((n, d), dtype=torch.float32, device=device)
+
+    # Pinned host buffer lets the copy back overlap with the next forward pass
+    use_cuda = torch.device(device).type == "cuda"
+    return torch.empty((n, d), dtype=torch.float32, pin_memory=use_cuda)
+
 # Direct copy from original codebase.
 # Less complicated then it looks. Just loops through all images in the dataset
 # running them through the model in batches. They are saved in an array of dimension
 # (num_images, final_layer_neurons). Offset stuff just handles copying each batch into the
-# right place. Targets are saved in a similar shaped array using the same process (unused here).
-def extract_features(loader, model, device, ignore_first=False, numpy=False, verbose=True):
+# right place. Targets are only collected if return_targets is set, otherwise None is
+# returned in their place. They're gathered per batch and concatenated once at the end.
+# Set keep_on_device to leave the features on the device rather than copying back to host.
+def extract_features(loader, model, device, ignore_first=False, numpy=False, verbose=True, 
+                     keep_on_device=False, return_targets=False):
     assert not model.training
-    with torch.no_grad():
+    use_cuda = torch.device(device).type == "cuda"
+    autocast = use_autocast(device)
+    with torch.inference_mode():
         n = len(loader.dataset)
         features = None
         # targets = np.zeros((n), dtype=int)
 
         offset = 0
+        batch_count = 0
         start = time.time()
         for elements in loader:
             if ignore_first:
                 elements = elements[1:]
 
             img = elements[0]
-            ft = model(img.to(device, non_blocking=True))
+            # Inference only, so bfloat16 activations are plenty - features are stored in float32
+            with torch.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE, enabled=autocast):
+                ft = model(img.to(device, non_blocking=True, memory_format=torch.channels_last))
             sz = img.size(0)
 
             if features is None:
                 d = ft.size(1)
                 # features = np.zeros((n, d), dtype=np.float32)
-                features = torch.zeros((n, d), dtype=torch.float32)
-                all_targets = [torch.zeros((n, ), dtype=int) for _ in elements[1:]]
+                features = allocate_features(n, d, device, keep_on_device)
+                all_targets = [[] for _ in elements[1:]]
 
-            features[offset:offset+sz] = ft.cpu().detach()#.numpy()
+            features[offset:offset+sz].copy_(ft.detach().float(), non_blocking=True)
 
-            for target, targets in zip(elements[1:], all_targets):
-                targets[offset:offset+sz] = target#.numpy()
+            if return_targets:
+                for target, targets in zip(elements[1:], all_targets):
+                    targets.append(target)
 
             offset += sz
-            if offset % (100 * sz) == 0 and verbose:
+            batch_count += 1
+            # Report on power of two batch counts, keeps the clock and stdout out of the hot path
+            if verbose and (batch_count & (batch_count - 1)) == 0:
                 speed = offset / (time.time() - start)
-                eta = (len(loader)*sz - offset) / speed
+                eta = (n - offset) / speed
                 print(f"Speed: {speed}, ETA: {eta}")
 
             # if offset >= 20000 and n >= 1e6:
@@ -83,37 +140,230 @@ def extract_features(loader, model, device, ignore_first=False, numpy=False, ver
             #     break
 
         assert offset == n
+        if use_cuda:
+            torch.cuda.synchronize()
+
+        if return_targets:
+            all_targets = [torch.cat(targets) for targets in all_targets]
+        else:
+            all_targets = [None for _ in all_targets]
         # if offset < n:
         #     features = features[:offset]
         #     all_targets = tuple([targets[:offset] for targets in all_targets])
 
         if numpy:
             features = features.numpy()
-            all_targets = [targets.numpy() for targets in all_targets]
+            all_targets = [targets if targets is None else targets.numpy() for targets in all_targets]
 
         return (features,) + tuple(all_targets)
 
-def get_data_loader(batch_size, num_workers):
+# Same as extract_features but runs every model over each batch before moving on, so the
+# dataset is only loaded, preprocessed and copied to the device once regardless of how
+# many models we need features from. Returns a list of feature arrays, one per model.
+# On CUDA each model runs on its own stream so the forward passes can overlap, and a
+# short last batch is padded to the full batch size (main uses 250, dividing CIFAR10's
+# 10000 test images, so normally there's nothing to pad).
+def extract_features_multi(loader, models, device, keep_on_device=False):
+    assert not any(model.training for model in models)
+    use_cuda = torch.device(device).type == "cuda"
+    autocast = use_autocast(device)
+    streams = [torch.cuda.Stream() if use_cuda else None for _ in models]
+    with torch.inference_mode():
+        n = len(loader.dataset)
+        features = [None] * len(models)
 
+        offset = 0
+        for img, _ in loader:
+            sz = img.size(0)
+            if use_cuda and loader.batch_size is not None and sz < loader.batch_size:
+                # Pad a short last batch so compiled models only ever see one shape
+                padding = img.new_zeros((loader.batch_size - sz, *img.shape[1:]))
+                img = torch.cat([img, padding])
+            img_gpu = img.to(device, non_blocking=True, memory_format=torch.channels_last)
+
+            for i, model in enumerate(models):
+                if use_cuda:
+                    # Wait for the batch to land, and stop the allocator reusing it too early
+                    streams[i].wait_stream(torch.cuda.current_stream())
+                    img_gpu.record_stream(streams[i])
+
+                with torch.cuda.stream(streams[i]):
+                    with torch.autocast(device_type="cuda", dtype=AUTOCAST_DTYPE, enabled=autocast):
+                        ft = model(img_gpu)
+
+                # Allocated outside the side stream so the caching allocator ties the buffer to
+                # the current stream, which is where the features get used afterwards
+                if features[i] is None:
+                    features[i] = allocate_features(n, ft.size(1), device, keep_on_device)
+
+                with torch.cuda.stream(streams[i]):
+                    features[i][offset:offset+sz].copy_(ft[:sz].detach().float(), non_blocking=True)
+
+            offset += sz
+
+        assert offset == n
+        if use_cuda:
+            torch.cuda.synchronize()
+
+        return features
+
+def align_features(features_marking, features_target, rtol=1e-5):
+    """
+    Least squares solution X of features_marking @ X = features_target via the normal
+    equations. The Gram matrix is only (d, d) so a Cholesky solve is much cheaper than
+    running lstsq on the full (n, d) features. Accumulated in float64 as forming the
+    normal equations squares the condition number. If the Cholesky factor shows the
+    features are ill-conditioned (smallest / largest diagonal entry below rtol) this
+    falls back to a rank revealing lstsq instead.
+    """
+    A = features_marking.double()
+    B = features_target.double()
+    G = A.T @ A
+
+    # Just enough ridge to absorb float64 rounding in G, scaled to its magnitude
+    ridge = torch.finfo(G.dtype).eps * G.diagonal().sum()
+    G.diagonal().add_(ridge)
+    L, info = torch.linalg.cholesky_ex(G)
+    L_diagonal = L.diagonal()
+    if info.item() != 0 or (L_diagonal.min() / L_diagonal.max()).item() < rtol:
+        logger.info("Features are ill-conditioned, falling back to lstsq.")
+        # Needs a rank revealing solve. cuSOLVER only has gels (QR without pivoting, assumes
+        # full rank) so this runs SVD based gelsd on the cpu, still in float64. Singular
+        # values below float32 precision are noise in float32 features so they're cut off.
+        rcond = torch.finfo(features_marking.dtype).eps
+        X = torch.linalg.lstsq(A.cpu(), B.cpu(), rcond=rcond, driver="gelsd").solution
+        return X.to(device=features_marking.device, dtype=features_marking.dtype)
+
+    X = torch.cholesky_solve(A.T @ B, L)
+    return X.to(features_marking.dtype)
+
+class CachedCIFAR(torch.utils.data.Dataset):
+    """
+    Runs the transform over the whole CIFAR10 split once and keeps the result in memory
+    (~120MB for the test set), so repeated passes don't decode and normalize again
+    """
+    def __init__(self, root, train=False, transform=None):
+        dataset = torchvision.datasets.CIFAR10(root, train=train, transform=transform)
+        self.classes = dataset.classes
+        self.data = torch.stack([img for img, _ in dataset])
+        self.targets = torch.tensor(dataset.targets)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        return self.data[index], self.targets[index]
+
+def get_data_loader(batch_size, num_workers=0):
+
+    # Keep workers alive between passes over the loader rather than respawning them
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = {"persistent_workers": True, "prefetch_factor": 4}
+
+    # Dataset is preprocessed up front so workers have nothing left to do by default
     dataset_directory = "experiments/datasets"
     test_transform = transforms.Compose([transforms.ToTensor(), NORMALIZE_CIFAR])
-    test_set = torchvision.datasets.CIFAR10(dataset_directory, train=False, transform=test_transform)
+    test_set = CachedCIFAR(dataset_directory, train=False, transform=test_transform)
     test_set_loader = torch.utils.data.DataLoader(test_set, 
                                                   batch_size=batch_size, 
                                                   num_workers=num_workers, 
                                                   shuffle=False,
-                                                  pin_memory=True)
+                                                  pin_memory=True,
+                                                  **worker_kwargs)
 
     return test_set_loader
 
-def main(batch_size=256, num_workers=1):
+def load_target_network(marked_network_path, device):
+    """
+    Loads a marked classifier checkpoint and returns the network with its fully
+    connected layer removed, ready for feature extraction, the removed layer's weights
+    and the rest of the checkpoint (epoch, accuracies etc)
+    """
+    # Left on the cpu, with mmap only the pages load_state_dict copies get read in
+    target_checkpoint = torch.load(marked_network_path, map_location="cpu", mmap=True, weights_only=True)
+    target_network = torchvision.models.resnet18(pretrained=False, num_classes=10)
+    target_network.load_state_dict(target_checkpoint["model_state_dict"])
+    target_network.to(device, memory_format=torch.channels_last)
+
+    # Keep the classifier weights then drop the layer, the network has its own copy
+    # of everything else so the checkpoint's weights can be released
+    fc_weight = target_network.fc.weight.detach().clone()
+    target_network.fc = nn.Identity()
+    target_network.eval()
+    del target_checkpoint["model_state_dict"]
+
+    return target_network, fc_weight, target_checkpoint
+
+def detect_radioactivity(carrier, features_marking, features_target, fc_weight, target_checkpoint):
+    """
+    Aligns the target network's feature space with the marking network's and tests the
+    target classifier for alignment with the carrier. features_marking only depends on
+    the marking network, so extract it once when testing several target networks.
+    Returns log10 of the combined p-value.
+    """
+    # Align spaces - everything stays on the device until we need the scores for the p-values
+    X = align_features(features_marking, features_target)
+    print("Norm of residual: %.4e" % (torch.linalg.norm(features_marking @ X - features_target)**2).item())
+
+    W = fc_weight @ X.T
+    W = W / W.norm(dim=1, keepdim=True)
+
+    # Computing scores - row-wise dot product of W with the carrier
+    scores = torch.einsum('ij,ij->i', W, carrier).cpu().numpy()
+
+    print("Mean p-value is at %d times sigma" % int(scores.mean() * np.sqrt(W.shape[0] * carrier.shape[1])))
+    print("Epoch of the model: %d" % target_checkpoint["epoch"])
+
+    p_vals = cosine_pvalue_vec(scores, d=carrier.shape[1])
+    log10_p = np.log10(fisher_combine_pvalues(p_vals)[1])
+    print(f"log10(p)={log10_p}")
+
+    return log10_p
+
+def load_cached_features(path, settings, device):
+    """
+    Returns the features saved at path by save_cached_features, or None if there aren't
+    any or they were extracted with different settings (device, autocast, dataset size...)
+    """
+    if not os.path.exists(path):
+        return None
+
+    cache = torch.load(path, map_location=device, mmap=True, weights_only=True)
+    cached_settings = cache.get("settings") if isinstance(cache, dict) else None
+    if cached_settings != settings:
+        logger.info(f"Cached features in {path} were extracted with {cached_settings}, "
+                    f"not {settings}. Extracting again.")
+        return None
+
+    features = cache["features"]
+    assert features.shape[0] == settings["num_images"]
+    return features
+
+def save_cached_features(path, features, settings):
+    torch.save({"features": features.cpu(), "settings": settings}, path)
+
+def main(batch_size=250, num_workers=0, marked_network_paths=None, cache_marking_features=True,
+         compile_networks=False):
+    """
+    Tests each marked network in marked_network_paths (defaults to the one produced by
+    train_marked_classifier.py) for radioactivity. The marking network and all target
+    networks are run over the test set in one pass. Returns the log10(p) of each.
+    The marking network's features never change so with cache_marking_features they're
+    saved after the first run and loaded from disk on later runs.
+    compile_networks runs the networks through torch.compile on CUDA. Off by default,
+    compiling each network costs more than an eager pass over the CIFAR10 test set
+    unless a lot of images are being run through.
+    """
 
     # Setup paths and logger
     experiment_directory = "experiments/radioactive/"
     output_directory = os.path.join(experiment_directory, "detect_radioactivity")
     logfile_path = os.path.join(output_directory, "logfile.txt")
     carrier_path = os.path.join(experiment_directory, "carriers.pth")
-    marked_network_path = "experiments/radioactive/train_marked_classifier/checkpoint.pth"
+    features_marking_path = os.path.join(output_directory, "features_marking.pth")
+    if marked_network_paths is None:
+        marked_network_paths = ["experiments/radioactive/train_marked_classifier/checkpoint.pth"]
     
     os.makedirs(output_directory, exist_ok=True)
     setup_logger(logfile_path)
@@ -126,52 +376,77 @@ def main(batch_size=256, num_workers=1):
     # Setup Dataloader
     test_set_loader = get_data_loader(batch_size, num_workers)
 
-    # Load Carrier
-    carrier = torch.load(carrier_path).numpy()
-
-    # Recreate marking network and remove fully connected layer
-    marking_network = torchvision.models.resnet18(pretrained=True)
-    marking_network.fc = nn.Sequential()
-    marking_network.to(device)
-    marking_network.eval()    
+    # Load Carrier - mmap + weights_only skips unpickling the whole file up front.
+    # Carriers are stored in half precision, upcast here so the scoring is all float32.
+    carrier = torch.load(carrier_path, map_location=device, mmap=True, weights_only=True).float()
+
+    # Recreate marking network and remove fully connected layer, unless we have its features
+    # Everything that changes the marking features, so a stale cache doesn't get reused
+    cache_settings = {
+        "num_images": len(test_set_loader.dataset),
+        "device_type": device.type,
+        "autocast_dtype": str(AUTOCAST_DTYPE) if use_autocast(device) else None,
+        "marking_network": "resnet18-pretrained",
+        "torchvision_version": torchvision.__version__,
+    }
+    features_marking = None
+    if cache_marking_features:
+        features_marking = load_cached_features(features_marking_path, cache_settings, device)
+
+    use_cached_features = features_marking is not None
+    marking_networks = []
+    if not use_cached_features:
+        marking_network = torchvision.models.resnet18(pretrained=True)
+        marking_network.fc = nn.Identity()
+        marking_network.to(device, memory_format=torch.channels_last)
+        marking_network.eval()
+        marking_networks.append(marking_network)
 
     t = Timer()
     t.start()
 
-    # Load Target Network and remove fully connected layer
-    target_checkpoint = torch.load(marked_network_path)
-    target_network = torchvision.models.resnet18(pretrained=False, num_classes=10)
-    target_network.load_state_dict(target_checkpoint["model_state_dict"])
-    target_network.fc = nn.Sequential()
-    target_network.to(device)
-    target_network.eval()
+    # Load Target Networks and remove fully connected layer
+    target_networks, fc_weights, target_checkpoints = zip(*[load_target_network(path, device) 
+                                                            for path in marked_network_paths])
+
+    # Compile without CUDA graphs - all cudagraph tree graphs share one memory pool that
+    # assumes they replay one after another, which breaks with each model on its own stream
+    networks = [*marking_networks, *target_networks]
+    if use_cuda and compile_networks:
+        networks = [torch.compile(network, fullgraph=True) for network in networks]
 
     # Extract features
     logger.info("Extracting image features after running through marking and target networks.")
-    features_marking, _ = extract_features(test_set_loader, marking_network, device, verbose=False)
-    features_target, _  = extract_features(test_set_loader, target_network, device, verbose=False)
-    features_marking = features_marking.numpy()
-    features_target = features_target.numpy()
-
-    # Align spaces
-    X, residuals, rank, s = np.linalg.lstsq(features_marking, features_target)
-    print("Norm of residual: %.4e" % np.linalg.norm(np.dot(features_marking, X) - features_target)**2)
-
-    W = target_checkpoint["model_state_dict"]["fc.weight"].cpu().numpy()
-    W = np.dot(W, X.T)
-    W /= np.linalg.norm(W, axis=1, keepdims=True)
-
-    # Computing scores
-    scores = np.sum(W * carrier, axis=1)
-
-    print("Mean p-value is at %d times sigma" % int(scores.mean() * np.sqrt(W.shape[0] * carrier.shape[1])))
-    print("Epoch of the model: %d" % target_checkpoint["epoch"])
-
-    p_vals = [cosine_pvalue(c, d=carrier.shape[1]) for c in list(scores)]
-    print(f"log10(p)={np.log10(combine_pvalues(p_vals)[1])}")
+    # Input shapes are fixed so let cuDNN pick the fastest convolution algorithms. Only for
+    # the extraction, so the setting doesn't stick around in the caller's session.
+    cudnn_benchmark = torch.backends.cudnn.benchmark
+    torch.backends.cudnn.benchmark = True
+    try:
+        all_features = extract_features_multi(test_set_loader, networks, device, keep_on_device=True)
+    finally:
+        torch.backends.cudnn.benchmark = cudnn_benchmark
+
+    if use_cached_features:
+        logger.info(f"Using cached marking network features from {features_marking_path}")
+        all_features_target = all_features
+    else:
+        features_marking, *all_features_target = all_features
+        if cache_marking_features:
+            save_cached_features(features_marking_path, features_marking, cache_settings)
+
+    log10_p_values = []
+    for path, features_target, fc_weight, target_checkpoint in zip(marked_network_paths, 
+                                                                   all_features_target, 
+                                                                   fc_weights,
+                                                                   target_checkpoints):
+        logger.info(f"Detecting radioactivity in {path}")
+        log10_p_values.append(detect_radioactivity(carrier, features_marking, features_target, 
+                                                   fc_weight, target_checkpoint))
 
     elapsed_time = t.stop()
     print("Total took %.2f" % (elapsed_time))
 
+    return log10_p_values
+
 if __name__ == '__main__':
     main()
@@ -298,7 +298,11 @@ if __name__ == '__main__':
     carriers = torch.randn(len(training_set.classes), marking_network_fc_feature_size)
     carriers /= torch.norm(carriers, dim=1, keepdim=True)
     class_id = 9
+    # Stored in half precision, plenty for the dot products in detection. Mark with the
+    # same rounded values so marking and detection use identical carriers.
+    carriers = carriers.half()
     torch.save(carriers, os.path.join(experiment_directory, "carriers.pth"))
+    carriers = carriers.float()
 
     # Run!
     #optimizer = lambda x : torch.optim.SGD(x, lr=1) # Doesn't produce good loss